@@ -2,10 +2,177 @@ import base64
 import requests
 import random
 import sys
+import os
+import json
+import mmap
+import time
+import argparse
+import threading
+import heapq
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 from datetime import datetime, timedelta
 
+try:
+    import resource  # Not available on Windows, peak memory just isn't reported there
+except ImportError:
+    resource = None
+
+REPLACEMENT_BATCH_SIZE = 100  # Most orders the bulk create endpoint accepts per request
+REPLACEMENT_CANCEL_WORKERS = 4  # Concurrent DELETEs when cancelling replaced orders
+CLIMATE_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zip3_normals.bin')  # Built by build_climate_index.py
+
+
+class Tracer:
+    """
+    Records spans for each order and each outbound API call, and writes them to path as Chrome trace JSON
+    which can be opened in chrome://tracing or https://ui.perfetto.dev. Does nothing unless a path is given.
+    At most buffer_size events are held in memory, the rest are flushed to the file as the run goes.
+    """
+    def __init__(self, path=None, buffer_size=1000):
+        self.path = path
+        self.enabled = path is not None
+        self.buffer_size = buffer_size
+        self.events = []
+        self.written = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter()
+
+    @property
+    def current_order(self):
+        return getattr(self._local, 'order_number', None)
+
+    @current_order.setter
+    def current_order(self, order_number):
+        self._local.order_number = order_number
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """
+        Times the enclosed block. The yielded dict becomes the span's args, so callers can add fields like a status.
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        if self.current_order is not None:
+            args['orderNumber'] = self.current_order
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",  # Complete event, has both a start and a duration
+                "ts": round((start - self._start) * 1000000),
+                "dur": round((end - start) * 1000000),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args
+            }
+            with self._lock:
+                self.events.append(event)
+                buffer_full = len(self.events) >= self.buffer_size
+            if buffer_full:
+                self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered events to the trace file. Uses Chrome's JSON array format, which stays readable
+        even if the run is killed before close() adds the closing bracket.
+        """
+        with self._lock:
+            events, self.events = self.events, []
+        if not events or not self.enabled:
+            return
+
+        with self._write_lock:
+            try:
+                with open(self.path, 'a' if self.written else 'w') as trace_file:
+                    for event in events:
+                        trace_file.write(",\n" if self.written else "[\n")
+                        json.dump(event, trace_file)
+                        self.written += 1
+            except OSError as e:
+                print(f"Error writing trace file {self.path}: {e}")
+                self.enabled = False  # Nowhere to put the events, stop recording them
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.flush()
+        try:
+            with open(self.path, 'a' if self.written else 'w') as trace_file:
+                trace_file.write("\n]\n" if self.written else "[]\n")
+        except OSError as e:
+            print(f"Error writing trace file {self.path}: {e}")
+            return
+        print(f"Wrote {self.written} trace events to {self.path}")
+
+
+def approx_size(value):
+    """
+    Rough memory footprint in bytes of a value made of the dicts, lists and scalars the APIs return.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(key) + approx_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(item) for item in value)
+    return size
+
+
+class LRUCache:
+    """
+    Least recently used cache with an optional memory cap. Once the approximate size of its entries goes over
+    max_bytes, the least recently used ones are evicted. Unbounded if max_bytes is None.
+    """
+    def __init__(self, name, max_bytes=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+        entry_size = approx_size(key) + approx_size(value)
+        if self.max_bytes is not None and entry_size > self.max_bytes:
+            return  # Would never fit, don't throw out everything else for it
+
+        self.entries[key] = (value, entry_size)
+        self.size += entry_size
+        while self.max_bytes is not None and self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def report(self):
+        limit = f" / {self.max_bytes / 1024:.0f} KB" if self.max_bytes is not None else ""
+        return f"{self.name}: {len(self.entries)} entries, {self.size / 1024:.1f} KB{limit}, {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+
 class ShipstationConnection:
-    def __init__(self, shipstationAPIKey, shipstaionAPISecret, UPSAuthID, UPSAuthPass, openWeatherAPIKey):
+    def __init__(self, shipstationAPIKey, shipstaionAPISecret, UPSAuthID, UPSAuthPass, openWeatherAPIKey, trace_file=None, climate_margin=12, cache_limits_mb=None):
         self.api_key = shipstationAPIKey
         self.api_secret = shipstaionAPISecret
         self.UPSAuthID = UPSAuthID
@@ -16,6 +183,21 @@ class ShipstationConnection:
         self.shipping_service = "ups_ground_saver"  # Default shipping service code
         self.nonliving = False
         self.expedite = False
+        self.tracer = Tracer(trace_file)
+        self.climate_margin = climate_margin  # How far inside the 40F/80F thresholds a climate normal must be to skip the forecast
+        self._climate_index = None  # Memory-mapped on first use
+        # Per-run caches, optionally capped in MB by name (products, weather, rates, transit)
+        cache_limits_mb = cache_limits_mb or {}
+        self.caches = {}
+        for name in ("products", "weather", "rates", "transit"):
+            limit_mb = cache_limits_mb.get(name)
+            self.caches[name] = LRUCache(name, max_bytes=int(limit_mb * 1024 * 1024) if limit_mb is not None else None)
+        self.product_cache = self.caches["products"]  # SKU -> whether the product is categorized as Nonliving
+        self.weather_cache = self.caches["weather"]  # ZIP -> forecast average high
+        self.rate_cache = self.caches["rates"]  # Rate request -> rates
+        self.transit_cache = self.caches["transit"]  # (origin, destination, weight, ship date) -> transit days
+        self.pending_replacements = []  # (original order id, new -R order payload), created in bulk once a batch is full
+        self.created_replacement_ids = set()  # -R orders created this run, so streamed pages don't process them again
 
     def _generate_headers(self):
         credentials = f"{self.api_key}:{self.api_secret}"
@@ -25,6 +207,20 @@ class ShipstationConnection:
             'Content-Type': 'application/json'
         }
 
+    def _request(self, method, url, **kwargs):
+        """
+        Sends an HTTP request, recording it as a span when tracing is enabled.
+        """
+        endpoint = urlsplit(url)
+        with self.tracer.span(f"{method} {endpoint.path}", "http", endpoint=f"{endpoint.netloc}{endpoint.path}") as span:
+            try:
+                response = requests.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                span['status'] = type(e).__name__
+                raise
+            span['status'] = response.status_code
+        return response
+
     def get_ups_access_token(self):
         url = "https://wwwcie.ups.com/security/v1/oauth/token"
 
@@ -35,7 +231,7 @@ class ShipstationConnection:
 
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-        response = requests.post(url, data=payload, headers=headers, auth=(self.UPSAuthID, self.UPSAuthPass))
+        response = self._request("POST", url, data=payload, headers=headers, auth=(self.UPSAuthID, self.UPSAuthPass))
         if response.status_code == 200:
             access_token = response.json()['access_token']
             return access_token
@@ -45,7 +241,7 @@ class ShipstationConnection:
 
     def cancel_order(self, order_id):
         url = f'{self.base_url}orders/{order_id}'
-        response = requests.delete(url, headers=self.headers)
+        response = self._request("DELETE", url, headers=self.headers)
 
         if response.status_code != 200:
             print(f'Error canceling order {order_id}:', response.text)
@@ -55,7 +251,7 @@ class ShipstationConnection:
 
     def get_order_details(self, order_id):
         url = f'{self.base_url}orders/{order_id}'
-        response = requests.get(url, headers=self.headers)
+        response = self._request("GET", url, headers=self.headers)
         if response.status_code == 200:
             return response.json()
         else:
@@ -64,7 +260,7 @@ class ShipstationConnection:
 
     def get_product_details(self, sku):
         url = f'{self.base_url}products?sku={sku}'
-        response = requests.get(url, headers=self.headers)
+        response = self._request("GET", url, headers=self.headers)
         if response.status_code == 200:
             products = response.json()
             if products and 'products' in products and products['products']:
@@ -83,7 +279,7 @@ class ShipstationConnection:
         }
         url = f'{self.base_url}orders/addtag'
         tag_data = {"orderId": order['orderId'], "tagId": tags[tag]}
-        response = requests.post(url, headers=self.headers, json=tag_data)
+        response = self._request("POST", url, headers=self.headers, json=tag_data)
         if response.status_code == 200:
             print(f'Order {order["orderNumber"]} tagged successfully.')
         else:
@@ -113,35 +309,75 @@ class ShipstationConnection:
             "confirmation": "delivery",
             "residential": order['shipTo']['residential']
         }
-        response = requests.post(url, headers=self.headers, json=data)
+
+        cache_key = json.dumps(data, sort_keys=True)
+        rates = self.rate_cache.get(cache_key)
+        if rates is not None:
+            return rates
+
+        response = self._request("POST", url, headers=self.headers, json=data)
         if response.status_code == 200:
-            return response.json()
+            rates = response.json()
+            self.rate_cache.put(cache_key, rates)
+            return rates
         else:
             print(f'Error fetching shipping rates: {response.text}')
             return None
 
-    def get_all_orders(self):
-        url = f'{self.base_url}orders'
-        params = {
-            'pageSize': 500,
-            'orderStatus': 'awaiting_shipment'
-        }
-        response = requests.get(url, headers=self.headers, params=params)
-
-        #print(requests.get(f'{self.base_url}carriers', headers=self.headers).json())
-
-        if response.status_code != 200:
-            print('Error fetching orders:', response.text)
-            return []
-
-        return response.json().get('orders', [])
-
-    def update_order(self, order_id, order_key, order_number, order_date, order_status, bill_to, ship_to, items, tags, storeId, weight, temp, shipByDays, email, source, requestedShipping, custom3, shipping_service=None, notes=None):
+    def iter_orders(self, page_size=500):
         """
-        Updated to accept a dynamic shipping_service and optional notes parameter.
+        Yields awaiting orders oldest first, fetching one page at a time so only a single page is held in memory.
+        Pages start from the date of the last order seen rather than going by page number, so orders that get shipped
+        or cancelled while this runs don't shift the ones after them out of the pages.
         """
+        url = f'{self.base_url}orders'
+        page = 1
+        date_start = None
+        recent_orders = {}  # orderId -> orderDate of orders already yielded that the next page can return again
+        while True:
+            params = {
+                'pageSize': page_size,
+                'page': page,
+                'orderStatus': 'awaiting_shipment',
+                'sortBy': 'OrderDate',
+                'sortDir': 'ASC'
+            }
+            if date_start:
+                params['orderDateStart'] = date_start.strftime('%Y-%m-%d %H:%M:%S')
+            response = self._request("GET", url, headers=self.headers, params=params)
+
+            #print(requests.get(f'{self.base_url}carriers', headers=self.headers).json())
+
+            if response.status_code != 200:
+                print('Error fetching orders:', response.text)
+                return
+
+            data = response.json()
+            orders = data.get('orders', [])
+            new_orders = 0
+            for order in orders:
+                if order['orderId'] in recent_orders:
+                    continue
+                recent_orders[order['orderId']] = order['orderDate']
+                new_orders += 1
+                yield order
+
+            if page >= data.get('pages', 1):
+                return
+
+            if new_orders:
+                # Start the next page a second before the last order, the orders we've already seen since then are skipped
+                date_start = datetime.strptime(orders[-1]['orderDate'][:19], "%Y-%m-%dT%H:%M:%S") - timedelta(seconds=1)
+                cutoff = date_start.strftime("%Y-%m-%dT%H:%M:%S")
+                recent_orders = {order_id: order_date for order_id, order_date in recent_orders.items() if order_date >= cutoff}
+                page = 1
+            else:
+                page += 1  # A whole page of orders from the same second, step past it
 
-        url = f'{self.base_url}orders/createorder'
+    def get_all_orders(self):
+        return list(self.iter_orders())
+
+    def _build_order_payload(self, order_id, order_key, order_number, order_date, order_status, bill_to, ship_to, items, tags, storeId, weight, temp, shipByDays, email, source, requestedShipping, custom3, shipping_service=None, notes=None):
         ship_by_date = (datetime.strptime(order_date, "%Y-%m-%dT%H:%M:%S.%f000") + timedelta(days=(5 + shipByDays))).strftime('%Y-%m-%d')
         data = {
             "orderKey": order_key,
@@ -175,7 +411,17 @@ class ShipstationConnection:
         if order_id:
             data['orderId'] = order_id  # Add this on after since replacements dont pass this (creating a new order)
 
-        response = requests.post(url, headers=self.headers, json=data)
+        return data
+
+    def update_order(self, order_id, order_key, order_number, order_date, order_status, bill_to, ship_to, items, tags, storeId, weight, temp, shipByDays, email, source, requestedShipping, custom3, shipping_service=None, notes=None):
+        """
+        Updated to accept a dynamic shipping_service and optional notes parameter.
+        """
+
+        url = f'{self.base_url}orders/createorder'
+        data = self._build_order_payload(order_id, order_key, order_number, order_date, order_status, bill_to, ship_to, items, tags, storeId, weight, temp, shipByDays, email, source, requestedShipping, custom3, shipping_service, notes)
+
+        response = self._request("POST", url, headers=self.headers, json=data)
 
         if response.status_code != 200:
             print(f'Error updating order {order_id}:', response.text)
@@ -185,57 +431,67 @@ class ShipstationConnection:
 
         return True, order_id
 
-    def is_all_nonliving(self, order):
+    def create_orders(self, payloads):
         """
-        Determines if all items in an order are categorized as 'Nonliving'.
+        Creates several orders at once with the bulk endpoint (up to REPLACEMENT_BATCH_SIZE per request).
+        Returns a dictionary of order number -> new order ID for the orders that were created successfully.
         """
-        nonliving_category = "Nonliving"
-        all_nonliving = True
+        url = f'{self.base_url}orders/createorders'
+        created = {}
 
-        for item in order['items']:
-            if item['sku']:  # Skip any item missing a sku
-                product_details = self.get_product_details(item['sku'])
-                if not product_details:
-                    all_nonliving = False
-                    print(f"Could not fetch product details for SKU {item['sku']}, assuming not all nonliving.")
-                    break
-                categories = product_details.get('productCategory', [])
-                if isinstance(categories, dict):
-                    if "Nonliving" not in categories.values():
-                        all_nonliving = False
-                        break
-                elif isinstance(categories, list):
-                    if "Nonliving" not in categories:
-                        all_nonliving = False
-                        break
+        for start in range(0, len(payloads), REPLACEMENT_BATCH_SIZE):
+            batch = payloads[start:start + REPLACEMENT_BATCH_SIZE]
+            response = self._request("POST", url, headers=self.headers, json=batch)
+
+            if response.status_code != 200:
+                print(f'Error creating {len(batch)} orders:', response.text)
+                continue
+
+            for result in response.json().get('results', []):
+                if result.get('success'):
+                    created[result['orderNumber']] = result['orderId']
                 else:
-                    all_nonliving = False
-                    break
+                    print(f"Error creating order {result.get('orderNumber')}: {result.get('errorMessage')}")
 
-        return all_nonliving
+        return created
 
-    def remove_nonliving_items(self, order):
-        nonliving_category = "Nonliving"
-        living_items = []
+    def is_nonliving_sku(self, sku):
+        """
+        Checks if a product is categorized as 'Nonliving'. Results are remembered so each SKU is only looked up once per run.
+        Products that can't be fetched are treated as living.
+        """
+        nonliving = self.product_cache.get(sku)
+        if nonliving is not None:
+            return nonliving
+
+        product_details = self.get_product_details(sku)
+        if not product_details:
+            print(f"Could not fetch product details for SKU {sku}, assuming living item.")
+            return False  # Not remembered, so a temporary API failure doesn't stick for the whole run
+
+        categories = product_details.get('productCategory', [])
+        if isinstance(categories, dict):
+            nonliving = "Nonliving" in categories.values()
+        elif isinstance(categories, list):
+            nonliving = "Nonliving" in categories
+        else:
+            nonliving = False  # Default to assuming the item is living if categorization is unknown
 
+        self.product_cache.put(sku, nonliving)
+        return nonliving
+
+    def is_all_nonliving(self, order):
+        """
+        Determines if all items in an order are categorized as 'Nonliving'.
+        """
         for item in order['items']:
-            product_details = self.get_product_details(item['sku'])
-            if not product_details:
-                print(f"Could not fetch product details for SKU {item['sku']}, assuming living item.")
-                living_items.append(item)  # Assume item is living if details are unavailable
-                continue
+            if item['sku'] and not self.is_nonliving_sku(item['sku']):  # Skip any item missing a sku
+                return False
 
-            categories = product_details.get('productCategory', [])
-            if isinstance(categories, dict):
-                if nonliving_category not in categories.values():
-                    living_items.append(item)  # Add item if it's not nonliving
-            elif isinstance(categories, list):
-                if nonliving_category not in categories:
-                    living_items.append(item)
-            else:
-                living_items.append(item)  # Default to assuming the item is living if categorization is unknown
+        return True
 
-        return living_items
+    def remove_nonliving_items(self, order):
+        return [item for item in order['items'] if not item['sku'] or not self.is_nonliving_sku(item['sku'])]
 
     def is_replacement_order(self, order):
 
@@ -284,7 +540,12 @@ class ShipstationConnection:
             "shipDate": datetime.now().strftime("%Y-%m-%d")  # Shipping date in YYYY-MM-DD format
         }
 
-        response = requests.post(url, headers=headers, json=payload)
+        cache_key = (origin_zip, destination_zip, payload["weight"], payload["shipDate"])
+        cached_transit_times = self.transit_cache.get(cache_key)
+        if cached_transit_times is not None:
+            return cached_transit_times
+
+        response = self._request("POST", url, headers=headers, json=payload)
 
         if response.status_code != 200:
             print(f"Error fetching Time in Transit data: {response.status_code} - {response.text}")
@@ -316,6 +577,7 @@ class ShipstationConnection:
         # If UPS Ground Saver is not provided, default to UPS Ground + 1
         transit_times['ups_ground_saver'] = transit_times['ups_ground'] + 1 if transit_times['ups_ground'] else None
 
+        self.transit_cache.put(cache_key, transit_times)
         return transit_times
 
     def delay_order(self, order_id, delay_days):
@@ -325,7 +587,7 @@ class ShipstationConnection:
             'orderId': order_id,
             'holdUntilDate': new_hold_date
         }
-        response = requests.post(url, headers=self.headers, json=payload)
+        response = self._request("POST", url, headers=self.headers, json=payload)
 
         if response.status_code != 200:
             print(f'Error delaying order {order_id}:', response.text)
@@ -343,13 +605,18 @@ class ShipstationConnection:
         base_url = "http://api.openweathermap.org/data/2.5/forecast"
         if "-" in zip_code:
             zip_code = zip_code.split("-")[0]
+
+        cached_high = self.weather_cache.get(zip_code)
+        if cached_high is not None:
+            return cached_high
+
         params = {
             'zip': f'{zip_code},US',  # Assuming US ZIP codes, adjust the country if needed
             'units': 'imperial',  # Fahrenheit
             'appid': api_key
         }
 
-        response = requests.get(base_url, params=params)
+        response = self._request("GET", base_url, params=params)
 
         if response.status_code != 200:
             print(f"Error fetching weather data for ZIP {zip_code}: {response.text}")
@@ -366,8 +633,94 @@ class ShipstationConnection:
 
         # Average the temperatures over the next 7 days
         average_high = round(sum(high_temperatures) / len(high_temperatures))
+        self.weather_cache.put(zip_code, average_high)
         return average_high
 
+    def order_priority(self, order):
+        """
+        Cheap classification of an order for scheduling, using only data already on the order (no API calls).
+        Lower numbers are processed first.
+        """
+        tags = order.get('tagIds', [])
+        if not tags:
+            tags = []
+        requested_service = order.get('requestedShippingService') or ""
+
+        if "EXPEDITE" in requested_service:
+            return 0
+        if 30832 in tags:  # Impatient customer asking about their order
+            return 1
+        if self.is_replacement_order(order):
+            return 2
+        if datetime.strptime(order['orderDate'], "%Y-%m-%dT%H:%M:%S.%f000") + timedelta(days=6) < datetime.now():
+            return 3  # Late
+        if "Select" in requested_service:
+            return 4
+        return 5
+
+    def schedule_orders(self, orders):
+        """
+        Sorts orders by priority, oldest first within the same priority.
+        """
+        return sorted(orders, key=lambda order: (self.order_priority(order), order['orderDate']))
+
+    def scheduled_orders(self, window=None, scan_until=None):
+        """
+        Yields awaiting orders, most urgent first. With a window, orders are streamed and at most that many are held
+        in memory at once. A first pass over the pages keeps up to window of the most urgent orders (expedited,
+        impatient and replacements) and handles them first. The rest are then streamed oldest first.
+        If scan_until (a time.monotonic() value) passes during the first pass, it stops listing pages early and
+        goes on with the urgent orders it found so far.
+        """
+        if not window:
+            yield from self.schedule_orders(self.get_all_orders())
+            return
+
+        def urgent_orders():
+            for order in self.iter_orders(page_size=min(window, 500)):
+                if scan_until is not None and time.monotonic() > scan_until:
+                    print("Ran out of time looking for urgent orders, handling the ones found so far")
+                    return
+                priority = self.order_priority(order)
+                if priority <= 2:  # Late orders aren't included, in a backfill that would be nearly all of them
+                    yield (priority, order['orderDate'], order['orderId']), order
+
+        # nsmallest only ever holds window entries while it goes through the pages
+        urgent = [order for _, order in heapq.nsmallest(window, urgent_orders(), key=lambda entry: entry[0])]
+        print(f"Handling {len(urgent)} urgent orders first")
+
+        urgent_ids = {order['orderId'] for order in urgent}
+        yield from urgent
+        del urgent
+        orders = (order for order in self.iter_orders(page_size=min(window, 500))
+                  if order['orderId'] not in urgent_ids and order['orderId'] not in self.created_replacement_ids)
+        while True:
+            batch = list(itertools.islice(orders, window))
+            if not batch:
+                return
+            yield from self.schedule_orders(batch)
+
+    def get_climate_normal(self, zip_code, date):
+        """
+        Looks up the normal mean temperature, (high + low) / 2, for the given ZIP code's 3-digit prefix in the month of
+        the given date, using the bundled climate index. This is comparable to get_temperature_high, which averages
+        every forecast reading including nights. Returns None if there is no data.
+        """
+        if self._climate_index is None:
+            try:
+                with open(CLIMATE_INDEX_PATH, 'rb') as index_file:
+                    self._climate_index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                print(f"Unable to load climate index {CLIMATE_INDEX_PATH}: {e}")
+                self._climate_index = False  # Don't try again every order
+
+        prefix = zip_code[:3]
+        if not self._climate_index or not prefix.isdigit():
+            return None
+
+        normal = self._climate_index[int(prefix) * 12 + date.month - 1]
+        return normal if normal else None
+
     def determine_best_shipping(self, order):
 
         self.nonliving = False
@@ -375,7 +728,6 @@ class ShipstationConnection:
         origin_zip = "23236"
         destination_zip = order['shipTo']['postalCode']
         weight_lbs = order['weight']['value']
-        temperature_high = self.get_temperature_high(destination_zip)
         order_total = order['orderTotal']  # Get the total amount for the order
         # Default max days for shipping based on temperature
         max_days = 4
@@ -386,9 +738,21 @@ class ShipstationConnection:
                 print("Prioritizing order with Impatient tag")
                 dayOffset = -4
 
+        # Skip the forecast if the climate normals for the forecast window are nowhere near the ice/heat pack thresholds
+        climate_normals = [self.get_climate_normal(destination_zip, datetime.now() + timedelta(days=day)) for day in (0, 5)]
+        if None not in climate_normals and all(40 + self.climate_margin < normal < 80 - self.climate_margin for normal in climate_normals):
+            temperature_high = climate_normals[0]
+            print(f"Climate normal for ZIP {destination_zip} is {temperature_high}, skipping the weather forecast")
+        else:
+            temperature_high = self.get_temperature_high(destination_zip)
+
         if temperature_high is None:
             print(f"Unable to determine temperature for ZIP {destination_zip}.")
-            temperature_high = 70  # Assume neutral temperature if API call fails.
+            if climate_normals[0] is not None:
+                temperature_high = climate_normals[0]  # Fall back to the climate normal if the API call fails.
+                print(f"Using climate normal of {temperature_high}")
+            else:
+                temperature_high = 70  # Assume neutral temperature if there's no climate data either.
 
         # Adjust delivery days based on temperature
         if temperature_high > 80 or temperature_high < 40:
@@ -542,102 +906,193 @@ class ShipstationConnection:
         print("No cheaper services found, defaulting to UPS 3 Day Select.")
         return "ups_3_day_select", notes, temperature_high, dayOffset
 
-    def run(self):
-        orders = self.get_all_orders()
-        subscriptions = Subscriptions(self)
+    def process_order(self, order, subscriptions):
+        print(
+            f"\nChecking order: {order['orderNumber']} - Status: {order['orderStatus']} - Items: {len(order['items'])} - Weight: {order['weight']['value']}")
 
-        for order in orders:
-            print(
-                f"\nChecking order: {order['orderNumber']} - Status: {order['orderStatus']} - Items: {len(order['items'])} - Weight: {order['weight']['value']}")
-
-            # Process subscription orders first
-            subscription_processed = subscriptions.process_subscription_orders(order)
-
-            if subscription_processed:
-                print(
-                    f"Processed subscription order {order['orderNumber']}. Proceeding with regular order updates for the original order.")
-                continue
+        # Process subscription orders first
+        subscription_processed = subscriptions.process_subscription_orders(order)
 
+        if subscription_processed:
+            print(
+                f"Processed subscription order {order['orderNumber']}. Proceeding with regular order updates for the original order.")
+            return
+
+
+        # Continue with regular order processing, including for the modified original order
+        tags = order.get('tagIds', [])
+        if not tags:
+            tags = []
+        items = order['items']
+        orderKey = order['orderKey']
+        orderId = order['orderId']
+        orderNumber = order['orderNumber']
+        orderDate = order['orderDate']
+
+        # Check REPLACEMENTS before looking up shipping, so replacements with nothing to send don't cost any rate lookups
+        replaced_order_id = None
+        if self.is_replacement_order(order):
+            print(f"Order {orderNumber} is a replacement - Processing accordingly.")
+            items = self.remove_nonliving_items(order)
+            if not items:
+                print("NO ITEMS IN ORDER - JUST SKIPPING IT!")
+                self.tag_order(order, "nonliving")  # Everything in it is nonliving
+                return
+
+            tags.append(25911)
+            if 30806 in tags:  # Remove the flag to process the order as a replacement
+                tags.remove(30806)
+            replaced_order_id = orderId  # Cancelled once the -R order has been created
+
+        # Determine the best shipping service and any special notes based on temperature
+        selected_service, notes, temp, shipByDays = self.determine_best_shipping(order)
+
+        if selected_service is None:
+            selected_service = self.shipping_service  # Use default if not specified
+
+        if replaced_order_id:
+            shipByDays = -5
+            orderKey = None
+            orderId = None
+            orderNumber = f"{orderNumber}-R"
+            orderDate = (datetime.now() - timedelta(days=5)).strftime(
+                "%Y-%m-%dT%H:%M:%S.%f000")  # Sets it as if the order was placed 5 days ago to prioritize the replacements.
+            notes += " [REPLACEMENT - ADD 3 FREE STEMS]"
+
+        # CHECK IF ORDER IS LATE
+        if datetime.strptime(orderDate, "%Y-%m-%dT%H:%M:%S.%f000") + timedelta(days=6) < datetime.now():
+            print("Order is late! Prioritizing and tagging late!")
+            tags.append(31803)  # LATE tag
+            shipByDays -= 4
+            if not self.nonliving:
+                notes += " [ADD 3 FREE STEMS FOR DELAY]"  # Only add free stems if they bought other plants
+
+        # Add a reminder if there is stuff with more than 1 quantity
+        multipleItemReminder = ""
+        multipleItemCount = sum(1 for item in items if item['quantity'] > 1)
+        if multipleItemCount == 1:
+            multipleItemReminder = f"Note: {multipleItemCount} item has a quantity of 2 or more!"
+        if multipleItemCount > 1:
+            multipleItemReminder = f"Note: {multipleItemCount} items have a quantity of 2 or more!"
+
+        order_fields = dict(
+            order_id=orderId,
+            order_key=orderKey,
+            order_number=orderNumber,
+            order_date=orderDate,
+            order_status=order['orderStatus'],
+            bill_to=order['billTo'],
+            ship_to=order['shipTo'],
+            items=items,
+            tags=tags,
+            storeId=order.get('advancedOptions', {}).get('storeId'),
+            weight=order['weight'],
+            temp=temp,
+            source=order.get('advancedOptions', {}).get('source'),
+            shipByDays=shipByDays,
+            custom3=multipleItemReminder,
+            email=order['customerEmail'],
+            requestedShipping=order['requestedShippingService'],
+            shipping_service=selected_service,  # Pass the selected shipping service
+            notes=notes  # Pass any notes such as "Include Ice Pack" or "Include Heat Pack"
+        )
+
+        # Replacements are created in bulk by run(), as soon as there's a full batch of them
+        if replaced_order_id:
+            self.pending_replacements.append((replaced_order_id, self._build_order_payload(**order_fields)))
+            print(f"Queued replacement order {orderNumber}")
+            return
+
+        # Update the order with the selected shipping service and any notes
+        success = self.update_order(**order_fields)
+
+        if success:
+            print(f"Order {order['orderNumber']} updated with shipping service: {selected_service} \n")
+        else:
+            print(f"Failed to update shipping service for order {order['orderNumber']}")
 
-            # Continue with regular order processing, including for the modified original order
-            tags = order.get('tagIds', [])
-            if not tags:
-                tags = []
-            items = order['items']
-            orderKey = order['orderKey']
-            orderId = order['orderId']
-            orderNumber = order['orderNumber']
-            orderDate = order['orderDate']
-
-            # Determine the best shipping service and any special notes based on temperature
-            selected_service, notes, temp, shipByDays = self.determine_best_shipping(order)
-
-            if selected_service is None:
-                selected_service = self.shipping_service  # Use default if not specified
-
-            # Check REPLACEMENTS
-            if self.is_replacement_order(order):
-                print(f"Order {orderNumber} is a replacement - Processing accordingly.")
-                tags.append(25911)
-                if 30806 in tags:  # Remove the flag to process the order as a replacement
-                    tags.remove(30806)
-                items = self.remove_nonliving_items(order)
-                if not items:
-                    print("NO ITEMS IN ORDER - JUST SKIPPING IT!")
-                    continue
+    def _cancel_replaced_order(self, order_id, order_number):
+        self.tracer.current_order = order_number
+        try:
+            if self.cancel_order(order_id):
+                print(f"Cancelled order {order_id}, replaced by {order_number}")
+        except requests.RequestException as e:
+            print(f"Error canceling order {order_id}, replaced by {order_number}: {e}")
 
-                self.cancel_order(orderId)
-                shipByDays = -5
-                orderKey = None
-                orderId = None
-                orderNumber = f"{orderNumber}-R"
-                orderDate = (datetime.now() - timedelta(days=5)).strftime(
-                    "%Y-%m-%dT%H:%M:%S.%f000")  # Sets it as if the order was placed 5 days ago to prioritize the replacements.
-                notes += " [REPLACEMENT - ADD 3 FREE STEMS]"
-
-            # CHECK IF ORDER IS LATE
-            if datetime.strptime(orderDate, "%Y-%m-%dT%H:%M:%S.%f000") + timedelta(days=6) < datetime.now():
-                print("Order is late! Prioritizing and tagging late!")
-                tags.append(31803)  # LATE tag
-                shipByDays -= 4
-                if not self.nonliving:
-                    notes += " [ADD 3 FREE STEMS FOR DELAY]"  # Only add free stems if they bought other plants
-
-            # Add a reminder if there is stuff with more than 1 quantity
-            multipleItemReminder = ""
-            multipleItemCount = sum(1 for item in items if item['quantity'] > 1)
-            if multipleItemCount == 1:
-                multipleItemReminder = f"Note: {multipleItemCount} item has a quantity of 2 or more!"
-            if multipleItemCount > 1:
-                multipleItemReminder = f"Note: {multipleItemCount} items have a quantity of 2 or more!"
-
-            # Update the order with the selected shipping service and any notes
-            success = self.update_order(
-                order_id=orderId,
-                order_key=orderKey,
-                order_number=orderNumber,
-                order_date=orderDate,
-                order_status=order['orderStatus'],
-                bill_to=order['billTo'],
-                ship_to=order['shipTo'],
-                items=items,
-                tags=tags,
-                storeId=order.get('advancedOptions', {}).get('storeId'),
-                weight=order['weight'],
-                temp=temp,
-                source=order.get('advancedOptions', {}).get('source'),
-                shipByDays=shipByDays,
-                custom3=multipleItemReminder,
-                email=order['customerEmail'],
-                requestedShipping=order['requestedShippingService'],
-                shipping_service=selected_service,  # Pass the selected shipping service
-                notes=notes  # Pass any notes such as "Include Ice Pack" or "Include Heat Pack"
-            )
-
-            if success:
-                print(f"Order {order['orderNumber']} updated with shipping service: {selected_service} \n")
+    def process_replacements(self):
+        """
+        Creates all queued -R replacement orders in bulk, then cancels the original of each one that was created.
+        Originals whose replacement failed to create are left in place.
+        """
+        if not self.pending_replacements:
+            return
+
+        # Take the batch off the queue before creating it, so a later error can never send the same -R orders again.
+        # If the create itself fails, the originals are still in place and get picked up by the next run.
+        replacements, self.pending_replacements = self.pending_replacements, []
+
+        print(f"\nCreating {len(replacements)} replacement orders")
+        with self.tracer.span("create replacements", "batch", count=len(replacements)):
+            created = self.create_orders([payload for _, payload in replacements])
+        self.created_replacement_ids.update(created.values())
+
+        to_cancel = []
+        for order_id, payload in replacements:
+            if payload['orderNumber'] in created:
+                to_cancel.append((order_id, payload['orderNumber']))
             else:
-                print(f"Failed to update shipping service for order {order['orderNumber']}")
+                print(f"Replacement {payload['orderNumber']} was not created, leaving the original order {order_id} in place.")
+
+        with ThreadPoolExecutor(max_workers=REPLACEMENT_CANCEL_WORKERS) as executor:
+            list(executor.map(lambda replaced: self._cancel_replaced_order(*replaced), to_cancel))
+
+    def report_memory(self):
+        print("\nCache memory:")
+        for cache in self.caches.values():
+            print(f"  {cache.report()}")
+        print(f"Pending replacements: {len(self.pending_replacements)}, {approx_size(self.pending_replacements) / 1024:.1f} KB")
+        if self.tracer.path is not None:
+            print(f"Trace buffer: {len(self.tracer.events)} events, {approx_size(self.tracer.events) / 1024:.1f} KB ({self.tracer.written} written to {self.tracer.path})")
+
+        if resource is not None:
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform != "darwin":
+                peak_rss *= 1024  # Linux reports KB, macOS reports bytes
+            print(f"Peak RSS: {peak_rss / (1024 * 1024):.1f} MB")
+
+    def run(self, deadline=None, window=None):
+        """
+        Processes all awaiting orders, most urgent first. If deadline (in seconds) is given, stops picking up new
+        orders once it has passed and leaves the rest for the next run. If window is given, orders are streamed
+        and at most that many are held in memory at once (see scheduled_orders). The search for urgent orders
+        then gets at most half the deadline, so there's time left to handle them.
+        """
+        start_time = time.monotonic()
+        scan_until = start_time + deadline / 2 if deadline is not None else None
+        try:
+            subscriptions = Subscriptions(self)
+
+            for index, order in enumerate(self.scheduled_orders(window, scan_until)):
+                if deadline is not None and time.monotonic() - start_time > deadline:
+                    print(f"\nDeadline of {deadline}s reached after {index} orders, leaving the rest for the next run.")
+                    break
+
+                self.tracer.current_order = order['orderNumber']
+                with self.tracer.span(f"order {order['orderNumber']}", "order", priority=self.order_priority(order)):
+                    self.process_order(order, subscriptions)
+                self.tracer.current_order = None
+
+                # Flushed here rather than in process_order so the batch isn't traced as part of one order
+                if len(self.pending_replacements) >= REPLACEMENT_BATCH_SIZE:
+                    self.process_replacements()
+        finally:
+            # Create whatever replacements are still queued, even if the run stopped with an error
+            try:
+                self.process_replacements()
+            except requests.RequestException as e:
+                print(f"Error creating the remaining {len(self.pending_replacements)} replacement orders: {e}")
+            self.tracer.close()
+            self.report_memory()
 
         return "Done!"
 
@@ -753,7 +1208,38 @@ class Subscriptions:
 
 if __name__ == "__main__":
     # Extract the arguments
-    _, shipstationAPIKey, shipstaionAPISecret, UPSAuthID, UPSAuthPass, openWeatherAPIKey = sys.argv
-
-    shipstation = ShipstationConnection(shipstationAPIKey, shipstaionAPISecret, UPSAuthID, UPSAuthPass, openWeatherAPIKey)
-    shipstation.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("shipstationAPIKey")
+    parser.add_argument("shipstaionAPISecret")
+    parser.add_argument("UPSAuthID")
+    parser.add_argument("UPSAuthPass")
+    parser.add_argument("openWeatherAPIKey")
+    parser.add_argument("--deadline", type=float, default=None, help="Stop picking up new orders after this many seconds")
+    parser.add_argument("--trace", default=None, help="Write a Chrome trace / Perfetto JSON timeline of the run to this file")
+    parser.add_argument("--climate-margin", type=int, default=12, help="Skip the weather forecast when climate normals are this many degrees inside the 40F/80F thresholds")
+    parser.add_argument("--window", type=int, default=None, help="Stream orders, holding at most this many in memory at once")
+    parser.add_argument("--cache-mb", type=float, default=None, help="Memory cap in MB for each cache (products, weather, rates, transit)")
+    parser.add_argument("--cache-limit", action="append", default=[], metavar="CACHE=MB", help="Memory cap in MB for one cache, overrides --cache-mb")
+    args = parser.parse_args()
+
+    if args.deadline is not None and not args.deadline >= 0:
+        parser.error("--deadline must be a number of at least 0")
+    if args.window is not None and args.window < 1:
+        parser.error("--window must be at least 1")
+    if args.cache_mb is not None and not 0 <= args.cache_mb < float("inf"):
+        parser.error("--cache-mb must be a number of at least 0")
+
+    cache_limits_mb = {name: args.cache_mb for name in ("products", "weather", "rates", "transit")}
+    for cache_limit in args.cache_limit:
+        name, _, limit_mb = cache_limit.partition("=")
+        if name not in cache_limits_mb:
+            parser.error(f"Unknown cache {name}, expected one of {', '.join(cache_limits_mb)}")
+        try:
+            cache_limits_mb[name] = float(limit_mb)  # Also fails if there was no "="
+        except ValueError:
+            parser.error(f"--cache-limit {cache_limit} should look like {name}=MB")
+        if not 0 <= cache_limits_mb[name] < float("inf"):
+            parser.error(f"--cache-limit {cache_limit} must be a number of at least 0")
+
+    shipstation = ShipstationConnection(args.shipstationAPIKey, args.shipstaionAPISecret, args.UPSAuthID, args.UPSAuthPass, args.openWeatherAPIKey, trace_file=args.trace, climate_margin=args.climate_margin, cache_limits_mb=cache_limits_mb)
+    shipstation.run(deadline=args.deadline, window=args.window)
@@ -0,0 +1,36 @@
+import csv
+import os
+
+# Builds zip3_normals.bin from zip3_normals.csv.
+# The index is 1000 rows (one per 3-digit ZIP prefix, 000-999) of 12 bytes (mean temperature in F for each month).
+# A value of 0 means there is no data for that prefix.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(HERE, 'zip3_normals.csv')
+INDEX = os.path.join(HERE, 'zip3_normals.bin')
+
+
+def build_index(source=SOURCE, index=INDEX):
+    table = bytearray(1000 * 12)
+
+    with open(source, newline='') as source_file:
+        rows = csv.DictReader(line for line in source_file if not line.startswith('#'))
+        for row in rows:
+            start, end = int(row['zip3_start']), int(row['zip3_end'])
+            means = [int(row[month]) for month in ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')]
+            if not 0 <= start <= end <= 999:
+                raise ValueError(f"Bad ZIP prefix range {row['zip3_start']}-{row['zip3_end']}")
+            if not all(1 <= mean <= 255 for mean in means):
+                raise ValueError(f"Temperatures for {row['region']} must be between 1 and 255F")
+
+            for prefix in range(start, end + 1):
+                table[prefix * 12:(prefix + 1) * 12] = bytes(means)
+
+    with open(index, 'wb') as index_file:
+        index_file.write(table)
+
+    print(f"Wrote {index}")
+
+
+if __name__ == "__main__":
+    build_index()